@@ -3,18 +3,35 @@
 # This server handles web dashboard requests, manages WebSocket communication for real-time updates,
 # processes voice commands via a simulated NLP service, and communicates with IoT devices via MQTT.
 
-import json
+# eventlet must patch the standard library before anything else imports it, so that the
+# MQTT network thread, SocketIO emits and HTTP requests all share one cooperative loop.
+import eventlet
+eventlet.monkey_patch()
+
+import atexit
+import functools
+import logging
+import os
+import queue
+import socket
+import struct
+import sys
 import time
-from flask import Flask, render_template_string
+from logging.handlers import QueueHandler, QueueListener
+from flask import Flask
 from flask_socketio import SocketIO, emit
 import paho.mqtt.client as mqtt
-from threading import Thread, Lock
+from threading import Lock
 
 # --- Basic Configuration ---
 # Flask & SocketIO App Initialization
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'secret!'
-socketio = SocketIO(app, cors_allowed_origins="[https://voice-house-security-system.vercel.app/](https://voice-house-security-system.vercel.app/)")
+# Optional message queue (e.g. redis://localhost:6379/0). When set, every emit is relayed
+# through it. Groundwork only: each process still runs its own MQTT client, so only a
+# single server process is supported for now.
+SOCKETIO_MESSAGE_QUEUE = os.environ.get("SOCKETIO_MESSAGE_QUEUE")
+socketio = SocketIO(app, async_mode='eventlet', message_queue=SOCKETIO_MESSAGE_QUEUE, cors_allowed_origins="[https://voice-house-security-system.vercel.app/](https://voice-house-security-system.vercel.app/)")
 
 # MQTT Broker Configuration
 MQTT_BROKER = 'localhost'
@@ -23,9 +40,24 @@ MQTT_PORT = 1883
 MQTT_TOPIC_COMMAND = "home/security/command"
 MQTT_TOPIC_STATUS = "home/security/status"
 
+# MQTT payloads are compact binary frames rather than JSON (keep in sync with iot_device.py).
+# A command message is one or more (device, command) frames back to back; a status message
+# is a single (device, state, auto-reset seconds) frame, where 0 means no auto-reset.
+DEVICE_IDS = {"door_lock_1": 1, "alarm_system": 2, "motion_sensor_1": 3}
+ACTIONS = {
+    "lock": 1, "unlock": 2, "locked": 3, "unlocked": 4,
+    "armed": 5, "disarmed": 6, "active": 7, "inactive": 8,
+}
+DEVICE_NAMES = {code: device_id for device_id, code in DEVICE_IDS.items()}
+ACTION_NAMES = {code: action for action, code in ACTIONS.items()}
+COMMAND_FRAME = struct.Struct("!BB")
+STATUS_FRAME = struct.Struct("!BBB")
+
 # --- In-Memory State Management ---
 # Using a dictionary to store the current state of all simulated devices.
-# A lock is used to ensure thread-safe access to this shared state.
+# The dictionary is copy-on-write: it is never mutated in place, writers build a new one
+# and swap the module-level reference. Readers just take `device_states` as a consistent
+# snapshot without locking; the lock only serializes writers against each other.
 device_states = {
     "door_lock_1": {"name": "Front Door Lock", "state": "locked"},
     "alarm_system": {"name": "Alarm System", "state": "disarmed"},
@@ -33,13 +65,44 @@ device_states = {
 }
 state_lock = Lock()
 
+def set_device_state(device_id, state):
+    """Publishes a new snapshot with the device's updated state. Returns the device name, or None if unknown."""
+    global device_states
+    with state_lock:
+        current = device_states
+        if device_id not in current:
+            return None
+        name = current[device_id]["name"]
+        updated = dict(current)
+        updated[device_id] = {"name": name, "state": state}
+        device_states = updated
+    return name
+
+# Status broadcasts are debounced deltas: devices changed within this window are collected
+# and each is sent once as a 'status_delta' with its latest state. Full 'status_update'
+# snapshots are only sent to newly connected dashboards.
+STATUS_EMIT_DELAY = 0.02  # seconds
+_emit_lock = Lock()
+_emit_scheduled = False
+_dirty_devices = set()
+
 # --- MQTT Client Setup ---
 # Handles communication with the simulated IoT devices.
 
+def disable_nagle(client):
+    """Sets TCP_NODELAY on the client's broker socket so small publishes are sent immediately."""
+    sock = client.socket()
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (AttributeError, OSError) as e:
+        # e.g. websocket transports that don't expose a raw TCP socket
+        print(f"MQTT Client: Could not set TCP_NODELAY: {e}")
+
 def on_connect(client, userdata, flags, rc):
     """Callback for when the client connects to the MQTT broker."""
     if rc == 0:
         print("MQTT Client: Connected to broker successfully.")
+        disable_nagle(client)
         # Subscribe to the status topic to receive updates from devices
         client.subscribe(MQTT_TOPIC_STATUS)
     else:
@@ -48,34 +111,89 @@ def on_connect(client, userdata, flags, rc):
 def on_message(client, userdata, msg):
     """Callback for when a message is received from the MQTT broker."""
     try:
-        payload = msg.payload.decode()
-        print(f"MQTT Client: Received status update -> {payload}")
-        data = json.loads(payload)
-        device_id = data.get("device_id")
-        state = data.get("state")
+        payload = msg.payload
+        # Cheap byte-level checks first, so foreign or junk messages on the topic
+        # are dropped before anything is unpacked or allocated
+        if len(payload) != STATUS_FRAME.size:
+            print("MQTT Client: Received malformed status frame.")
+            return
+        if payload[0] not in DEVICE_NAMES:
+            print(f"MQTT Client: Ignoring status for unknown device code {payload[0]}.")
+            return
+
+        device_code, state_code, auto_reset_after = STATUS_FRAME.unpack(payload)
+        device_id = DEVICE_NAMES[device_code]
+        state = ACTION_NAMES.get(state_code)
+        if state is None:
+            print(f"MQTT Client: Received unknown state code {state_code}.")
+            return
+        print(f"MQTT Client: Received status update -> {device_id}: {state}")
 
         # Update the state in a thread-safe manner
-        with state_lock:
-            if device_id in device_states:
-                device_states[device_id]["state"] = state
-                # Log the event and notify the web dashboard of the change
-                log_event(f"Device '{device_states[device_id]['name']}' updated state to '{state}'.")
-                socketio.emit('status_update', {"devices": device_states})
-    except json.JSONDecodeError:
-        print("MQTT Client: Received malformed JSON.")
+        name = set_device_state(device_id, state)
+        if name is not None:
+            # Log the event and notify the web dashboard of the change
+            log_event(f"Device '{name}' updated state to '{state}'.")
+            schedule_status_emit(device_id)
+            # Motion events carry their own reset delay instead of a second "inactive" message
+            if auto_reset_after:
+                socketio.start_background_task(reset_inactive_after, device_id, auto_reset_after)
     except Exception as e:
         print(f"MQTT Client: Error processing message: {e}")
 
+def schedule_status_emit(device_id):
+    """Marks a device as changed and schedules a debounced broadcast unless one is already pending."""
+    global _emit_scheduled
+    with _emit_lock:
+        _dirty_devices.add(device_id)
+        if _emit_scheduled:
+            return
+        _emit_scheduled = True
+    socketio.start_background_task(_flush_status_after, STATUS_EMIT_DELAY)
+
+def _flush_status_after(delay):
+    """Waits out the debounce window, then broadcasts the latest state of every changed device."""
+    global _emit_scheduled
+    socketio.sleep(delay)
+    # Take the dirty set and clear the flag before reading the state so that any
+    # update arriving from here on schedules another broadcast instead of being lost
+    with _emit_lock:
+        dirty = list(_dirty_devices)
+        _dirty_devices.clear()
+        _emit_scheduled = False
+    snapshot = device_states
+    for device_id in dirty:
+        details = snapshot[device_id]
+        socketio.emit('status_delta', {"id": device_id, "name": details["name"], "state": details["state"]})
+
+def reset_inactive_after(device_id, delay):
+    """Flips a device back to 'inactive' locally once its motion event has expired."""
+    socketio.sleep(delay)
+    # Skip the reset if the device was changed in the meantime
+    if device_states.get(device_id, {}).get("state") != "active":
+        return
+    name = set_device_state(device_id, "inactive")
+    if name is not None:
+        log_event(f"Device '{name}' updated state to 'inactive'.")
+        schedule_status_emit(device_id)
+
 # Initialize and configure the MQTT client
 mqtt_client = mqtt.Client()
+# No effect while every publish is QoS 0 (paho only counts QoS 1/2 as inflight); this just
+# keeps the default window of 20 from throttling command bursts if QoS is ever raised
+mqtt_client.max_inflight_messages_set(500)
 mqtt_client.on_connect = on_connect
 mqtt_client.on_message = on_message
 
 def start_mqtt_client():
-    """Connects to the MQTT broker and starts the network loop in a background thread."""
+    """
+    Connects to the MQTT broker and starts paho's network loop in its own managed thread.
+    loop_start() returns immediately; paho handles reconnects and the loop is stopped at exit.
+    """
     try:
         mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
-        mqtt_client.loop_forever()
+        mqtt_client.loop_start()
+        atexit.register(stop_mqtt_client)
     except ConnectionRefusedError:
         print("\n--- MQTT Connection Error ---")
         print(f"Could not connect to MQTT broker at {MQTT_BROKER}:{MQTT_PORT}.")
@@ -86,50 +204,113 @@ def start_mqtt_client():
     except Exception as e:
         print(f"MQTT Client: An unexpected error occurred: {e}")
 
+def stop_mqtt_client():
+    """Disconnects from the broker and joins paho's network thread."""
+    mqtt_client.disconnect()
+    mqtt_client.loop_stop()
+
 # --- Event Logging ---
+# [second, formatted timestamp] of the last strftime call; log bursts within a second reuse it
+_ts_cache = [0, ""]
+
+def now_timestamp():
+    """Returns the current local time as 'YYYY-MM-DD HH:MM:SS', formatting at most once per second."""
+    t = int(time.time())
+    if t != _ts_cache[0]:
+        _ts_cache[1] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t))
+        _ts_cache[0] = t
+    return _ts_cache[1]
+
+class SocketIOLogHandler(logging.Handler):
+    """Forwards log records to all connected web dashboards as 'log_event' messages."""
+    def emit(self, record):
+        socketio.emit('log_event', {'log': self.format(record)})
+
+# log_event() only enqueues the record; a background listener does the console
+# write and the SocketIO broadcast, so callers such as the MQTT callback never block on I/O
+_log_queue = queue.Queue()
+_console_handler = logging.StreamHandler(sys.stdout)
+_console_handler.setFormatter(logging.Formatter("Log: %(message)s"))
+log_listener = QueueListener(_log_queue, _console_handler, SocketIOLogHandler())
+log_listener.start()
+atexit.register(log_listener.stop)
+
+logger = logging.getLogger("voice-house-security")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+logger.addHandler(QueueHandler(_log_queue))
+
 def log_event(message):
     """Logs an event with a timestamp and sends it to the web dashboard."""
-    timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
-    log_entry = f"[{timestamp}] {message}"
-    print(f"Log: {log_entry}")
-    socketio.emit('log_event', {'log': log_entry})
+    timestamp = now_timestamp()
+    logger.info(f"[{timestamp}] {message}")
 
 # --- NLP Simulation ---
-def process_nlp(text):
+# The command rules as data, in the order their commands are emitted. Each rule is
+# (scope keywords, exclusive, branches); a branch is (keywords, device, action) and fires
+# when the scope and any of its keywords matched. In an exclusive rule only the first
+# matching branch fires (e.g. "unlock" wins over "lock"); a branch without keywords
+# fires whenever its scope matched.
+NLP_RULES = (
+    # Front door lock
+    (("front door", "front-door"), True, (
+        (("unlock",), "door_lock_1", "unlock"),
+        (("lock",), "door_lock_1", "lock"),
+    )),
+    # Alarm system
+    (("alarm",), True, (
+        (("disarm",), "alarm_system", "disarmed"),
+        (("arm",), "alarm_system", "armed"),
+    )),
+    # Motion / living room sensor
+    (("living room", "living-room"), False, (
+        (("activate", "turn on", "enable", "on"), "motion_sensor_1", "active"),
+        (("deactivate", "turn off", "disable", "off"), "motion_sensor_1", "inactive"),
+    )),
+    # Status query (special action); "what is the status" always contains "status"
+    (("status", "report"), False, (
+        ((), None, "query_status"),
+    )),
+)
+
+def _build_resolver(rules):
     """
-    A simplified NLP function that returns a list of device/action dicts for a given text.
-    Example return: [{"device": "door_lock_1", "action": "unlock"}, {"device": "motion_sensor_1", "action": "active"}]
+    Generates a function mapping lower-cased text to a tuple of (device, action) pairs.
+    The rules are unrolled into a flat if/elif chain of substring checks. A rule's branch
+    keywords are only checked once its scope matched, just like the hand-written version.
     """
-    text = (text or "").lower()
-    commands = []
-
-    # Front door lock
-    if "front door" in text or "front-door" in text:
-        # prefer explicit "unlock" over "lock" if both words appear
-        if "unlock" in text:
-            commands.append({"device": "door_lock_1", "action": "unlock"})
-        elif "lock" in text:
-            commands.append({"device": "door_lock_1", "action": "lock"})
+    def any_in(keywords):
+        return " or ".join(f"{keyword!r} in text" for keyword in keywords)
 
-    # Alarm system
-    if "alarm" in text:
-        if "disarm" in text:
-            commands.append({"device": "alarm_system", "action": "disarmed"})
-        elif "arm" in text:
-            commands.append({"device": "alarm_system", "action": "armed"})
+    lines = ["def _resolve_commands(text):", "    commands = []"]
+    for scope, exclusive, branches in rules:
+        lines.append(f"    if {any_in(scope)}:")
+        first = True
+        for keywords, device, action in branches:
+            command = f"commands.append({(device, action)!r})"
+            if not keywords:
+                lines.append(f"        {command}")
+                continue
+            keyword = "elif" if exclusive and not first else "if"
+            lines.append(f"        {keyword} {any_in(keywords)}:")
+            lines.append(f"            {command}")
+            first = False
+    lines.append("    return tuple(commands)")
 
-    # Motion / living room sensor
-    if "living room" in text or "living-room" in text:
-        if any(k in text for k in ("activate", "turn on", "enable", "on")):
-            commands.append({"device": "motion_sensor_1", "action": "active"})
-        if any(k in text for k in ("deactivate", "turn off", "disable", "off")):
-            commands.append({"device": "motion_sensor_1", "action": "inactive"})
+    namespace = {}
+    exec("\n".join(lines), namespace)
+    return namespace["_resolve_commands"]
 
-    # Status query (special action)
-    if "status" in text or "what is the status" in text or "report" in text:
-        commands.append({"device": None, "action": "query_status"})
+_resolve_commands = _build_resolver(NLP_RULES)
 
-    return commands
+@functools.lru_cache(maxsize=1024)
+def process_nlp(text):
+    """
+    A simplified NLP function that returns a tuple of (device, action) pairs for a given text.
+    Example return: (("door_lock_1", "unlock"), ("motion_sensor_1", "active"))
+    Results are cached on the raw text, so a repeated command costs a single dict lookup.
+    """
+    return _resolve_commands(" ".join((text or "").lower().split()))
 
 # Helper to normalize action -> state for optimistic UI updates
 def normalize_action_to_state(device_id, action):
@@ -152,11 +333,14 @@ def normalize_action_to_state(device_id, action):
 
 # --- Web Server (Flask) and WebSocket (SocketIO) Routes ---
 
+# The dashboard is a static page (no template variables), so it is read once at startup
+with open(os.path.join(app.root_path, "dashboard.html"), "r") as f:
+    DASHBOARD_HTML = f.read()
+
 @app.route('/')
 def index():
     """Serves the main web dashboard."""
-    with open("dashboard.html", "r") as f:
-        return render_template_string(f.read())
+    return DASHBOARD_HTML, 200, {"Cache-Control": "public, max-age=300"}
 
 @socketio.on('connect')
 def handle_connect():
@@ -164,8 +348,7 @@ def handle_connect():
     print('Client connected')
     log_event("Web dashboard connected to server.")
     # Send the initial state of all devices to the newly connected client
-    with state_lock:
-        emit('status_update', {"devices": device_states})
+    emit('status_update', {"devices": device_states})
 
 @socketio.on('disconnect')
 def handle_disconnect():
@@ -190,36 +373,35 @@ def handle_voice_command(data):
         return
 
     # First, handle any status query by reporting current states (but continue to process other actions)
-    for res in nlp_results:
-        if res.get("action") == "query_status":
+    for _, action in nlp_results:
+        if action == "query_status":
             log_event("Processing status query.")
-            with state_lock:
-                status_report = "Current Status Report: "
-                statuses = [f"{details['name']} is {details['state']}" for _, details in device_states.items()]
-                status_report += "; ".join(statuses) + "."
-                log_event(status_report)
+            statuses = "; ".join(f"{details['name']} is {details['state']}" for details in device_states.values())
+            log_event(f"Current Status Report: {statuses}.")
             # don't return here — allow other commands in the same utterance to be executed
 
-    # Publish all actionable commands to MQTT
-    for res in nlp_results:
-        device = res.get("device")
-        action = res.get("action")
-        if device and action and action != "query_status":
+    # Publish all actionable commands to MQTT as a single batch message
+    batch = []
+    for device, action in nlp_results:
+        if device and action != "query_status":
             log_event(f"NLP parsed: Control '{device}' to state '{action}'.")
-            command_payload = json.dumps({"device_id": device, "command": action})
-            try:
-                mqtt_client.publish(MQTT_TOPIC_COMMAND, command_payload)
-                log_event(f"Published command to MQTT: {command_payload}")
-            except Exception as e:
-                log_event(f"Failed to publish MQTT command: {e}")
+            batch.append((device, action))
+
+    if batch:
+        command_payload = b"".join(COMMAND_FRAME.pack(DEVICE_IDS[device], ACTIONS[action]) for device, action in batch)
+        try:
+            # QoS 0: commands are fire-and-forget, so don't wait on a PUBACK round-trip
+            mqtt_client.publish(MQTT_TOPIC_COMMAND, command_payload, qos=0)
+            published = ", ".join(f"{device}={action}" for device, action in batch)
+            log_event(f"Published command to MQTT: {published} ({command_payload.hex()})")
+        except Exception as e:
+            log_event(f"Failed to publish MQTT command: {e}")
 
 # --- Main Application Execution ---
 if __name__ == '__main__':
     print("Starting AIoT Home Security System...")
-    # Start the MQTT client in a separate thread
-    mqtt_thread = Thread(target=start_mqtt_client)
-    mqtt_thread.daemon = True
-    mqtt_thread.start()
+    # Connect to the broker; paho runs its network loop in its own thread
+    start_mqtt_client()
 
     # Start the Flask-SocketIO web server
     print("Starting web server on http://127.0.0.1:5000")
@@ -6,8 +6,11 @@
 
 import paho.mqtt.client as mqtt
 import time
-import json
 import random
+import sched
+import socket
+import struct
+import sys
 from threading import Thread
 
 # --- Configuration ---
@@ -15,21 +18,60 @@ MQTT_BROKER = 'localhost'
 MQTT_PORT = 1883
 MQTT_TOPIC_COMMAND = "home/security/command"
 MQTT_TOPIC_STATUS = "home/security/status"
+# MQTT payloads are compact binary frames rather than JSON (keep in sync with app.py).
+# A command message is one or more (device, command) frames back to back; a status message
+# is a single (device, state, auto-reset seconds) frame, where 0 means no auto-reset.
+DEVICE_IDS = {"door_lock_1": 1, "alarm_system": 2, "motion_sensor_1": 3}
+ACTIONS = {
+    "lock": 1, "unlock": 2, "locked": 3, "unlocked": 4,
+    "armed": 5, "disarmed": 6, "active": 7, "inactive": 8,
+}
+DEVICE_NAMES = {code: device_id for device_id, code in DEVICE_IDS.items()}
+ACTION_NAMES = {code: action for action, code in ACTIONS.items()}
+COMMAND_FRAME = struct.Struct("!BB")
+STATUS_FRAME = struct.Struct("!BBB")
+
+# Device states. Interned once so every device shares the same string objects and
+# state comparisons resolve on identity before falling back to a character compare.
+LOCKED = sys.intern("locked")
+UNLOCKED = sys.intern("unlocked")
+ARMED = sys.intern("armed")
+DISARMED = sys.intern("disarmed")
+ACTIVE = sys.intern("active")
+INACTIVE = sys.intern("inactive")
+
+# How long a motion event keeps the sensor active before it resets itself
+MOTION_RESET_SECONDS = 5
+
+# A single scheduler thread drives the motion simulation for every sensor,
+# instead of one sleeping thread per sensor
+motion_scheduler = sched.scheduler(time.time, time.sleep)
+
+def start_motion_scheduler():
+    """Runs all scheduled motion checks and resets in one background thread."""
+    scheduler_thread = Thread(target=motion_scheduler.run)
+    scheduler_thread.daemon = True
+    scheduler_thread.start()
 
 # --- Device Simulation Class ---
 class SimulatedDevice:
     """A base class for our simulated IoT devices."""
+    __slots__ = ("device_id", "state", "client")
+
     def __init__(self, device_id, initial_state, client):
         self.device_id = device_id
         self.state = initial_state
         self.client = client
         self.publish_status()
 
-    def publish_status(self):
-        """Publishes the current state of the device to the MQTT status topic."""
-        payload = json.dumps({"device_id": self.device_id, "state": self.state})
-        self.client.publish(MQTT_TOPIC_STATUS, payload)
-        print(f"Device '{self.device_id}': Published status -> {payload}")
+    def publish_status(self, auto_reset_after=None):
+        """
+        Publishes the current state of the device to the MQTT status topic.
+        If auto_reset_after is given, subscribers should reset the device themselves after that many seconds.
+        """
+        payload = STATUS_FRAME.pack(DEVICE_IDS[self.device_id], ACTIONS[self.state], auto_reset_after or 0)
+        self.client.publish(MQTT_TOPIC_STATUS, payload, qos=0)
+        print(f"Device '{self.device_id}': Published status -> {self.state} ({payload.hex()})")
         
     def process_command(self, command):
         """Processes a command and updates the device state if applicable."""
@@ -38,9 +80,11 @@ class SimulatedDevice:
 
 # --- Specific Device Implementations ---
 class DoorLock(SimulatedDevice):
+    __slots__ = ()
+
     def process_command(self, command):
         if command in ["lock", "unlock"]:
-            new_state = "locked" if command == "lock" else "unlocked"
+            new_state = LOCKED if command == "lock" else UNLOCKED
             if self.state != new_state:
                 print(f"Device '{self.device_id}': Changing state from '{self.state}' to '{new_state}'.")
                 self.state = new_state
@@ -49,24 +93,27 @@ class DoorLock(SimulatedDevice):
                 print(f"Device '{self.device_id}': Already in '{new_state}' state.")
 
 class AlarmSystem(SimulatedDevice):
+    __slots__ = ()
+
     def process_command(self, command):
         if command in ["armed", "disarmed"]:
-            if self.state != command:
-                print(f"Device '{self.device_id}': Changing state from '{self.state}' to '{command}'.")
-                self.state = command
+            new_state = ARMED if command == "armed" else DISARMED
+            if self.state != new_state:
+                print(f"Device '{self.device_id}': Changing state from '{self.state}' to '{new_state}'.")
+                self.state = new_state
                 self.publish_status()
             else:
-                print(f"Device '{self.device_id}': Already in '{command}' state.")
+                print(f"Device '{self.device_id}': Already in '{new_state}' state.")
 
 class MotionSensor(SimulatedDevice):
     """A sensor that randomly detects motion when the alarm is armed."""
+    __slots__ = ("alarm",)
+
     def __init__(self, device_id, initial_state, client, alarm_system):
         super().__init__(device_id, initial_state, client)
         self.alarm = alarm_system
-        # Start a background thread to simulate motion detection
-        self.simulation_thread = Thread(target=self.simulate_motion)
-        self.simulation_thread.daemon = True
-        self.simulation_thread.start()
+        # Queue the first motion check on the shared scheduler
+        self.schedule_motion_check()
 
     def process_command(self, command):
         """Process activation/deactivation commands sent from the broker."""
@@ -77,9 +124,9 @@ class MotionSensor(SimulatedDevice):
 
         # Accept both noun/states and verb forms
         if cmd in ("active", "activate", "on", "enable"):
-            new_state = "active"
+            new_state = ACTIVE
         elif cmd in ("inactive", "deactivate", "off", "disable"):
-            new_state = "inactive"
+            new_state = INACTIVE
         else:
             # unknown command for this device
             print(f"Device '{self.device_id}': Unsupported command '{command}'")
@@ -92,46 +139,71 @@ class MotionSensor(SimulatedDevice):
         else:
             print(f"Device '{self.device_id}': Already in '{new_state}' state.")
 
-    def simulate_motion(self):
-        """Periodically checks if it should trigger a motion event."""
-        while True:
-            time.sleep(random.randint(10, 25)) # Check for motion every 10-25 seconds
-            # Only trigger motion if the alarm is armed and the sensor is inactive
-            if self.alarm.state == "armed" and self.state == "inactive" and random.random() < 0.3: # 30% chance
-                print(f"Device '{self.device_id}': Motion Detected!")
-                self.state = "active"
-                self.publish_status()
-                # Reset to inactive after a short period
-                time.sleep(5)
-                self.state = "inactive"
-                self.publish_status()
+    def schedule_motion_check(self):
+        """Schedules the next motion check on the shared scheduler."""
+        motion_scheduler.enter(random.randint(10, 25), 0, self.maybe_trigger) # Check for motion every 10-25 seconds
+
+    def maybe_trigger(self):
+        """Checks if it should trigger a motion event, then schedules the next check."""
+        # Only trigger motion if the alarm is armed and the sensor is inactive
+        if self.alarm.state == ARMED and self.state == INACTIVE and random.random() < 0.3: # 30% chance
+            print(f"Device '{self.device_id}': Motion Detected!")
+            self.state = ACTIVE
+            # A single message covers the whole event: the server resets its own copy of
+            # the state after MOTION_RESET_SECONDS, so the reset is never published.
+            self.publish_status(auto_reset_after=MOTION_RESET_SECONDS)
+            motion_scheduler.enter(MOTION_RESET_SECONDS, 0, self.reset_motion)
+        self.schedule_motion_check()
+
+    def reset_motion(self):
+        """Returns the sensor to inactive once a motion event has expired."""
+        self.state = INACTIVE
 
 # --- MQTT Client for Devices ---
+def disable_nagle(client):
+    """Sets TCP_NODELAY on the client's broker socket so small publishes are sent immediately."""
+    sock = client.socket()
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (AttributeError, OSError) as e:
+        print(f"IoT Devices: Could not set TCP_NODELAY: {e}")
+
 def on_connect(client, userdata, flags, rc):
     """Callback for MQTT connection."""
     if rc == 0:
         print("IoT Devices: Connected to MQTT Broker.")
+        disable_nagle(client)
         client.subscribe(MQTT_TOPIC_COMMAND)
     else:
         print(f"IoT Devices: Failed to connect, return code {rc}")
 
+def dispatch_command(device_id, command):
+    """Routes a single command to the matching device object."""
+    if device_id in devices:
+        devices[device_id].process_command(command)
+    else:
+        print(f"IoT Devices: Received command for unknown device '{device_id}'")
+
 def on_message(client, userdata, msg):
     """Callback for processing received commands."""
     try:
-        payload = msg.payload.decode()
-        print(f"IoT Devices: Received command -> {payload}")
-        data = json.loads(payload)
-        device_id = data.get("device_id")
-        command = data.get("command")
-        
-        # Route the command to the correct device object
-        if device_id in devices:
-            devices[device_id].process_command(command)
-        else:
-            print(f"IoT Devices: Received command for unknown device '{device_id}'")
+        payload = msg.payload
+        # A length check rejects junk on the topic before any frame is unpacked
+        if not payload or len(payload) % COMMAND_FRAME.size:
+            print("IoT Devices: Received malformed command frame.")
+            return
+
+        # The server batches every command of an utterance into one message of back-to-back frames
+        for device_code, command_code in COMMAND_FRAME.iter_unpack(payload):
+            # Skip frames for devices this simulator doesn't know before decoding the command
+            if device_code not in DEVICE_NAMES:
+                print(f"IoT Devices: Received command for unknown device code {device_code}")
+                continue
+            device_id = DEVICE_NAMES[device_code]
+            command = ACTION_NAMES.get(command_code)
+            print(f"IoT Devices: Received command -> {device_id}: {command}")
+            dispatch_command(device_id, command)
 
-    except json.JSONDecodeError:
-        print("IoT Devices: Received malformed JSON command.")
     except Exception as e:
         print(f"IoT Devices: Error processing command: {e}")
 
@@ -140,6 +212,9 @@ if __name__ == "__main__":
     print("Starting IoT Device Simulator...")
     
     device_client = mqtt.Client()
+    # No effect while every publish is QoS 0 (paho only counts QoS 1/2 as inflight); this just
+    # keeps the default window of 20 from throttling status bursts if QoS is ever raised
+    device_client.max_inflight_messages_set(500)
     device_client.on_connect = on_connect
     device_client.on_message = on_message
     
@@ -152,13 +227,15 @@ if __name__ == "__main__":
         exit(1) # Exit if the broker isn't available
 
     # Initialize all our simulated devices
-    alarm = AlarmSystem("alarm_system", "disarmed", device_client)
+    alarm = AlarmSystem("alarm_system", DISARMED, device_client)
     devices = {
-        "door_lock_1": DoorLock("door_lock_1", "locked", device_client),
+        "door_lock_1": DoorLock("door_lock_1", LOCKED, device_client),
         "alarm_system": alarm,
-        "motion_sensor_1": MotionSensor("motion_sensor_1", "inactive", device_client, alarm)
+        "motion_sensor_1": MotionSensor("motion_sensor_1", INACTIVE, device_client, alarm)
     }
 
+    start_motion_scheduler()
+
     print("IoT devices are running and listening for commands.")
     # The loop_forever() call is blocking and will keep the script running.
     device_client.loop_forever()